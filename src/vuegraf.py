@@ -1,57 +1,85 @@
 #!/usr/bin/env python3
 
 import datetime
+import functools
 import json
+import os
+import queue
 import signal
 import sys
+import tempfile
 import time
-from threading import Event
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+import numpy as np
+import requests
+from botocore.exceptions import BotoCoreError
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
 from pyemvue import PyEmVue
 from pyemvue.enums import Scale, Unit, TotalTimeFrame, TotalUnit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-if len(sys.argv) != 2:
-    print('Usage: python {} <config-file>'.format(sys.argv[0]))
-    sys.exit(1)
-
-configFilename = sys.argv[1]
-config = {}
-with open(configFilename) as configFile:
-    config = json.load(configFile)
-
-# Only authenticate to ingress if 'user' entry was provided in config
-if 'user' in config['influxDb']:
-    influx = InfluxDBClient(host=config['influxDb']['host'], port=config['influxDb']['port'], username=config['influxDb']['user'], password=config['influxDb']['pass'], database=config['influxDb']['database'])
-else:
-    influx = InfluxDBClient(host=config['influxDb']['host'], port=config['influxDb']['port'], database=config['influxDb']['database'])
-
-influx.create_database(config['influxDb']['database'])
-
-running = True
-
-# flush=True helps when running in a container without a tty attached
+INTERVAL_SECS=60
+LAG_SECS=5
+WRITE_BATCH_SIZE=5000
+UDP_BATCH_SIZE=10
+MAX_FETCH_WORKERS=16
+WRITE_QUEUE_SIZE=100
+WRITE_FLUSH_SECS=1
+DISCOVERY_INTERVAL_SECS=300
+MAX_BACKOFF_SECS=900
+CATCHUP_WINDOW_SECS=300
+EMPTY_CHANNEL_PULLS=10
+EMPTY_PROBE_PULLS=10
+MAX_CATCHUP_SECS=3600
+SECOND_RETENTION_SECS=3*3600
+STATE_FILENAME='vuegraf_state.json'
+RESET_WINDOW_SECS=7*24*3600
+RESET_GRACE_SECS=60
+
+LOG_LEVELS = {'INFO': 20, 'ERROR': 40}
+logThreshold = LOG_LEVELS['INFO']
+
+class State:
+    # Shared between the pull loop and the signal handlers
+    def __init__(self):
+        self.running = True
+        self.pauseEvent = Event()
+
+# Flushing helps when running in a container without a tty attached
 # (alternatively, "python -u" or PYTHONUNBUFFERED will help here)
-def log(level, msg):
-    now = datetime.datetime.utcnow()
-    print('{} | {} | {}'.format(now, level.ljust(5), msg), flush=True)
-
-def info(msg):
-    log("INFO", msg)
-
-def error(msg):
-    log("ERROR", msg)
-
-def handleExit(signum, frame):
-    global running
+def log(level, msg, *args):
+    # Messages below the configured level are dropped before any formatting is done
+    if LOG_LEVELS[level] < logThreshold:
+        return
+    if args:
+        msg = msg.format(*args)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    # One write per line keeps messages from the writer thread from interleaving with the pull loop
+    sys.stdout.write('{} | {} | {}\n'.format(now, level.ljust(5), msg))
+    sys.stdout.flush()
+
+def info(msg, *args):
+    log("INFO", msg, *args)
+
+def error(msg, *args):
+    log("ERROR", msg, *args)
+
+def handleExit(state, signum, frame):
     error('Caught exit signal')
-    running = False
-    pauseEvent.set()
+    state.running = False
+    state.pauseEvent.set()
 
 def populateDevices(account):
     deviceIdMap = {}
     account['deviceIdMap'] = deviceIdMap
     channelIdMap = {}
     account['channelIdMap'] = channelIdMap
+    channelNameMap = {}
+    account['channelNameMap'] = channelNameMap
+    account['linePrefixMap'] = {}
     devices = account['vue'].get_devices()
     for device in devices:
         device = account['vue'].populate_device_properties(device)
@@ -61,10 +89,17 @@ def populateDevices(account):
             if chan.name is None and chan.channel_num == '1,2,3':
                 chan.name = device.device_name
             channelIdMap[key] = chan
-            info("Discovered new channel: {} ({})".format(chan.name, chan.channel_num))
+            channelNameMap[(device.device_gid, chan.channel_num)] = resolveChannelName(account, device.device_name, chan.channel_num)
+            info("Discovered new channel: {} ({})", chan.name, chan.channel_num)
+    account['lastDiscoveryTime'] = time.monotonic()
+
+def escapeTag(value):
+    # Same escaping as influxdb.line_protocol; backslashes go first so later escapes aren't doubled
+    return str(value).replace('\\', '\\\\').replace(' ', '\\ ').replace(',', '\\,').replace('=', '\\=').replace('\n', '\\n')
 
 def lookupDeviceName(account, device_gid):
-    if device_gid not in account['deviceIdMap']:
+    # Rediscovering devices is a full round of API calls, so do it at most once per interval
+    if device_gid not in account['deviceIdMap'] and time.monotonic() - account['lastDiscoveryTime'] > DISCOVERY_INTERVAL_SECS:
         populateDevices(account)
 
     deviceName = "{}".format(device_gid)
@@ -72,93 +107,387 @@ def lookupDeviceName(account, device_gid):
         deviceName = account['deviceIdMap'][device_gid].device_name
     return deviceName
 
+def resolveChannelName(account, deviceName, channelNum):
+    device = account['configDeviceMap'].get(deviceName)
+    if device is None:
+        return "{}-{}".format(deviceName, channelNum)
+
+    # Combined channels such as the '1,2,3' mains are named after the device
+    if not channelNum.isdigit():
+        return deviceName
+    num = int(channelNum)
+    if 'channels' in device and 0 < num <= len(device['channels']):
+        return device['channels'][num - 1]
+    return "{}-{}".format(deviceName, channelNum)
+
 def lookupChannelName(account, chan):
-    if chan.device_gid not in account['deviceIdMap']:
-        populateDevices(account)
+    key = (chan.device_gid, chan.channel_num)
+    if key in account['channelNameMap']:
+        return account['channelNameMap'][key]
 
     deviceName = lookupDeviceName(account, chan.device_gid)
-    name = "{}-{}".format(deviceName, chan.channel_num)
-    if 'devices' in account:
-        for device in account['devices']:
-            if 'name' in device and device['name'] == deviceName:
-                try:
-                    num = int(chan.channel_num)
-                    if 'channels' in device and len(device['channels']) >= num:
-                        name = device['channels'][num - 1]
-                except:
-                    name = deviceName
+    name = resolveChannelName(account, deviceName, chan.channel_num)
+    # Only remember names for known devices, so unknown ones keep triggering discovery
+    if chan.device_gid in account['deviceIdMap']:
+        account['channelNameMap'][key] = name
     return name
 
-signal.signal(signal.SIGINT, handleExit)
-signal.signal(signal.SIGHUP, handleExit)
-
-pauseEvent = Event()
-
-INTERVAL_SECS=60
-LAG_SECS=5
-
-
-if config['influxDb']['reset']:
-    info('Resetting database')
-    influx.delete_series(measurement='energy_usage')
-
-
-while running:
-    for account in config["accounts"]:
-        tmpEndingTime = datetime.datetime.utcnow() - datetime.timedelta(seconds=LAG_SECS)
-
-        if 'vue' not in account:
-            account['vue'] = PyEmVue()
-            account['vue'].login(username=account['email'], password=account['password'])
-            info('Login completed')
-
-            populateDevices(account)
-
-            account['end'] = tmpEndingTime
-
-            start = account['end'] - datetime.timedelta(seconds=INTERVAL_SECS)
-
-            result = influx.query('select last(usage), time from energy_usage where account_name = \'{}\''.format(account['name']))
-            if len(result) > 0:
-                timeStr = next(result.get_points())['time'][:26] + 'Z'
-                tmpStartingTime = datetime.datetime.strptime(timeStr, '%Y-%m-%dT%H:%M:%S.%fZ')
-                if tmpStartingTime > start:
-                    start = tmpStartingTime
-        else:
-            start = account['end'] + datetime.timedelta(seconds=1)
-            account['end'] = tmpEndingTime
-
+def lookupLinePrefix(account, chan):
+    # Everything before the field value is identical for every point of a channel
+    key = (chan.device_gid, chan.channel_num)
+    if key in account['linePrefixMap']:
+        return account['linePrefixMap'][key]
+
+    chanName = lookupChannelName(account, chan)
+    tags = ''
+    for tagKey, tagValue in (('account_name', account['name']), ('device_name', chanName)):
+        # Like the client's make_lines, leave out tags that have no value
+        if tagValue is not None and str(tagValue) != '':
+            tags += ',{}={}'.format(tagKey, escapeTag(tagValue))
+    linePrefix = 'energy_usage{} usage='.format(tags)
+    if key in account['channelNameMap']:
+        account['linePrefixMap'][key] = linePrefix
+    return linePrefix
+
+def toApiTime(epoch):
+    # PyEmVue appends 'Z' to isoformat(), so it has to be handed naive UTC datetimes
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).replace(tzinfo=None)
+
+def formatLines(linePrefix, watts, timestamps):
+    # Bake the prefix into a %-template once; the per-point work is then a single C-level format
+    template = linePrefix.replace('%', '%%') + '%r %d'
+    return list(map(template.__mod__, zip(watts.tolist(), timestamps.tolist())))
+
+class PooledEmVue(PyEmVue):
+    # PyEmVue calls requests.get() directly, which opens a new TLS connection for
+    # every request; send them through a keep-alive session instead
+    def __init__(self):
+        super().__init__()
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=MAX_FETCH_WORKERS, max_retries=retry))
+
+    def _get_request(self, full_endpoint):
+        if not self.cognito:
+            raise Exception('Must call "login" before calling any API methods.')
+        self._check_token()
+        return self.session.get(full_endpoint, headers={'authtoken': self.cognito.id_token})
+
+def queryLastUsageTimes(influx):
+    # A single grouped query covers every account, instead of one query per account login
+    result = influx.query('select last(usage) from energy_usage group by account_name', epoch='s')
+    return {tags['account_name']: next(points)['time'] for (measurement, tags), points in result.items()}
+
+def quoteString(value):
+    # InfluxQL string literal, for values that appear in a WHERE clause
+    return "'{}'".format(str(value).replace('\\', '\\\\').replace("'", "\\'"))
+
+def resetUsage(influx, state, cutoff, accountNames):
+    # A reset left enabled in the config would wipe the history on every start, so give a chance to stop it first
+    error('Deleting all usage data before {} in {}s, stop Vuegraf now to cancel', toApiTime(cutoff), RESET_GRACE_SECS)
+    state.pauseEvent.wait(RESET_GRACE_SECS)
+    if not state.running:
+        info('Reset cancelled by shutdown')
+        return
+
+    # Deleting everything at once can tie up a large database, so go one time window at a time
+    try:
+        points = list(influx.query('select first(usage) from energy_usage', epoch='s').get_points())
+        windowStart = points[0]['time'] if points else cutoff
+        while state.running and windowStart < cutoff:
+            windowEnd = min(windowStart + RESET_WINDOW_SECS, cutoff)
+            influx.query('delete from energy_usage where time >= {}s and time < {}s'.format(windowStart, windowEnd), method='POST')
+            info('Reset deleted usage data up to {}', toApiTime(windowEnd))
+            windowStart = windowEnd
+        if windowStart < cutoff:
+            info('Reset stopped early by shutdown; deleted usage data up to {}', toApiTime(windowStart))
+            return
+
+        # DELETE leaves emptied series in the index, so drop those of accounts no longer being written
+        for tagValue in influx.query('show tag values from energy_usage with key = account_name').get_points():
+            if tagValue['value'] not in accountNames:
+                influx.query('drop series from energy_usage where account_name = {}'.format(quoteString(tagValue['value'])), method='POST')
+                info('Reset dropped series; account="{}"', tagValue['value'])
+        info('Reset complete')
+    except Exception:
+        error('Failed to reset database: {}', sys.exc_info())
+
+def loadLastUsageTimes(stateFilename):
+    try:
+        with open(stateFilename) as stateFile:
+            return json.load(stateFile)
+    except (OSError, ValueError):
+        return {}
+
+def saveLastUsageTimes(stateFilename, lastUsageTimes):
+    # Remember how far each account got so a restart doesn't have to scan InfluxDB for it.
+    # Written to a private temp file and renamed over the old one, so a crash never leaves it half written.
+    try:
+        fd, tmpFilename = tempfile.mkstemp(prefix='.vuegraf_state', dir=os.path.dirname(os.path.abspath(stateFilename)))
         try:
-            channels = account['vue'].get_recent_usage(Scale.MINUTE.value)
-            usageDataPoints = []
-            device = None
-            for chan in channels:
-                chanName = lookupChannelName(account, chan)
-
-                usage = account['vue'].get_usage_over_time(chan, start, account['end'])
-                index = 0
-                for watts in usage:
-                    if watts is not None:
-                        dataPoint = {
-                            "measurement": "energy_usage",
-                            "tags": {
-                                "account_name": account['name'],
-                                "device_name": chanName,
-                            },
-                            "fields": {
-                                "usage": watts,
-                            },
-                            "time": start + datetime.timedelta(seconds=index)
-                        }
-                        index = index + 1
-                        usageDataPoints.append(dataPoint)
-
-            info('Submitted datapoints to database; account="{}"; points={}'.format(account['name'], len(usageDataPoints)))
-            influx.write_points(usageDataPoints)
-        except:
-            error('Failed to record new usage data: {}'.format(sys.exc_info())) 
-
-    pauseEvent.wait(INTERVAL_SECS)
-
-info('Finished')
+            with os.fdopen(fd, 'w') as stateFile:
+                json.dump(lastUsageTimes, stateFile)
+            os.replace(tmpFilename, stateFilename)
+        except BaseException:
+            os.unlink(tmpFilename)
+            raise
+    except OSError:
+        error('Failed to save state file: {}', sys.exc_info())
+
+def deferAccount(account, start, pullTime):
+    # Rewind so the failed window is fetched again, and back off exponentially while it keeps failing
+    account['end'] = start - 1
+    account['failures'] = account.get('failures', 0) + 1
+    account['windowSecs'] = max(account['windowSecs'] // 2, INTERVAL_SECS)
+    backoff = min(INTERVAL_SECS * 2 ** (account['failures'] - 1), MAX_BACKOFF_SECS)
+    account['retryTime'] = pullTime + backoff
+    return backoff
+
+def queueDataPoints(writeQueue, accountBatches):
+    # Points stay grouped by account, with each account's end time, so progress is only recorded once the writer has stored it
+    pointCount = sum(len(usageDataPoints) for accountName, accountEnd, usageDataPoints in accountBatches)
+    try:
+        writeQueue.put_nowait(accountBatches)
+        info('Queued datapoints for database; points={}; queueDepth={}', pointCount, writeQueue.qsize())
+    except queue.Full:
+        error('Write queue is full, dropping datapoints; points={}', pointCount)
+
+def writeUsage(influx, writeQueue, writeBatchSize, lastUsageTimes):
+    # Runs on its own thread so a slow InfluxDB never delays the next pull
+    stopping = False
+    while not stopping:
+        accountBatches = writeQueue.get()
+        if accountBatches is None:
+            break
+        pointCount = sum(len(usageDataPoints) for accountName, accountEnd, usageDataPoints in accountBatches)
+
+        # Coalesce anything else arriving shortly after into the same write, until it is full
+        flushTime = time.monotonic() + WRITE_FLUSH_SECS
+        while pointCount < WRITE_BATCH_SIZE:
+            try:
+                pending = writeQueue.get(timeout=max(0.0, flushTime - time.monotonic()))
+            except queue.Empty:
+                break
+            if pending is None:
+                stopping = True
+                break
+            accountBatches.extend(pending)
+            pointCount += sum(len(usageDataPoints) for accountName, accountEnd, usageDataPoints in pending)
 
+        try:
+            usageDataPoints = [line for accountName, accountEnd, points in accountBatches for line in points]
+            influx.write_points(usageDataPoints, time_precision='s', batch_size=writeBatchSize, protocol='line')
+            lastUsageTimes.update((accountName, accountEnd) for accountName, accountEnd, points in accountBatches)
+            info('Submitted datapoints to database; points={}', pointCount)
+        except (requests.exceptions.RequestException, InfluxDBClientError, InfluxDBServerError):
+            error('Failed to write usage data, retrying each account separately; points={}: {}', pointCount, sys.exc_info())
+            writeAccountUsage(influx, accountBatches, writeBatchSize, lastUsageTimes)
+        except Exception:
+            error('Unexpected error writing usage data: {}', sys.exc_info())
+
+def writeAccountUsage(influx, accountBatches, writeBatchSize, lastUsageTimes):
+    # One account's bad points shouldn't cost every other account in the same write its data
+    failedAccounts = set()
+    for accountName, accountEnd, usageDataPoints in accountBatches:
+        try:
+            influx.write_points(usageDataPoints, time_precision='s', batch_size=writeBatchSize, protocol='line')
+            # A later batch mustn't move progress past an earlier one that failed
+            if accountName not in failedAccounts:
+                lastUsageTimes[accountName] = accountEnd
+            info('Submitted datapoints to database; account="{}"; points={}', accountName, len(usageDataPoints))
+        except (requests.exceptions.RequestException, InfluxDBClientError, InfluxDBServerError):
+            failedAccounts.add(accountName)
+            error('Failed to write usage data; account="{}"; points={}: {}', accountName, len(usageDataPoints), sys.exc_info())
+
+def main(argv):
+    global logThreshold
+
+    if len(argv) != 2:
+        print('Usage: python {} <config-file>'.format(argv[0]))
+        sys.exit(1)
+
+    configFilename = argv[1]
+    config = {}
+    with open(configFilename) as configFile:
+        config = json.load(configFile)
+
+    # Index the configured devices by name so channel naming doesn't scan the list
+    for account in config['accounts']:
+        account['configDeviceMap'] = {device['name']: device for device in account.get('devices', []) if 'name' in device}
+
+    logLevel = str(config.get('logLevel', 'INFO')).upper()
+    if logLevel not in LOG_LEVELS:
+        print('Invalid logLevel "{}" in {}; expected one of: {}'.format(config['logLevel'], configFilename, ', '.join(LOG_LEVELS)))
+        sys.exit(1)
+    logThreshold = LOG_LEVELS[logLevel]
+
+    influxArgs = {'host': config['influxDb']['host'], 'port': config['influxDb']['port'], 'database': config['influxDb']['database']}
+
+    # Only authenticate to ingress if 'user' entry was provided in config
+    if 'user' in config['influxDb']:
+        influxArgs['username'] = config['influxDb']['user']
+        influxArgs['password'] = config['influxDb']['pass']
+
+    # Points are sent as UDP datagrams if 'udpPort' entry was provided; queries still use HTTP
+    if 'udpPort' in config['influxDb']:
+        influxArgs['use_udp'] = True
+        influxArgs['udp_port'] = config['influxDb']['udpPort']
+
+    influx = InfluxDBClient(**influxArgs)
+
+    influx.create_database(config['influxDb']['database'])
+
+    # Keep each UDP datagram around a typical 1500 byte MTU (lines are roughly 100 bytes)
+    writeBatchSize = UDP_BATCH_SIZE if 'udpPort' in config['influxDb'] else WRITE_BATCH_SIZE
+
+    state = State()
+    signal.signal(signal.SIGINT, functools.partial(handleExit, state))
+    signal.signal(signal.SIGHUP, functools.partial(handleExit, state))
+    # Containers are stopped with SIGTERM, which is otherwise ignored when running as PID 1
+    signal.signal(signal.SIGTERM, functools.partial(handleExit, state))
+
+    if config['influxDb']['reset']:
+        info('Resetting database')
+        # Only data older than the first pull window is deleted, so polling can start right away
+        cutoff = int(time.time()) - LAG_SECS - INTERVAL_SECS
+        Thread(target=resetUsage, args=(influx, state, cutoff, {account['name'] for account in config['accounts']}), daemon=True).start()
+
+    # Kept beside the config file by default, since that is the directory a container mounts
+    stateFilename = config.get('stateFile', os.path.join(os.path.dirname(os.path.abspath(configFilename)), STATE_FILENAME))
+    # After a reset there is nothing to resume from, and backfilled points would only be deleted again
+    lastUsageTimes = {} if config['influxDb']['reset'] else loadLastUsageTimes(stateFilename)
+    if not config['influxDb']['reset'] and any(account['name'] not in lastUsageTimes for account in config['accounts']):
+        lastUsageTimes = queryLastUsageTimes(influx)
+
+    # Updated by the writer as points are stored, and saved on exit
+    writtenUsageTimes = dict(lastUsageTimes)
+    writeQueue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    writer = Thread(target=writeUsage, args=(influx, writeQueue, writeBatchSize, writtenUsageTimes), daemon=True)
+    writer.start()
+
+    # Shared by every pull so worker threads aren't started and torn down each interval
+    fetchExecutor = ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS)
+
+    while state.running:
+        # Pulls are scheduled from when this one started, so their own duration doesn't add drift
+        pullTime = time.monotonic()
+        nextPullTime = pullTime + INTERVAL_SECS
+
+        # All accounts' points go out together as a single write per pull
+        pullBatches = []
+        pullPointCount = 0
+        for account in config["accounts"]:
+            if pullTime < account.get('retryTime', 0):
+                continue
+
+            # Window bounds are whole epoch seconds; datetimes are only built for the API requests
+            tmpEndingTime = int(time.time()) - LAG_SECS
+
+            if 'vue' not in account:
+                account['vue'] = PooledEmVue()
+                account['vue'].login(username=account['email'], password=account['password'])
+                info('Login completed')
+
+                populateDevices(account)
+
+                account['end'] = tmpEndingTime
+
+                # Resume right after the last stored second, so the catch-up windows fill the gap from the restart
+                if account['name'] in lastUsageTimes:
+                    start = min(lastUsageTimes[account['name']] + 1, account['end'])
+                else:
+                    start = account['end'] - INTERVAL_SECS
+            else:
+                start = account['end'] + 1
+                account['end'] = tmpEndingTime
+
+            # Emporia only keeps second usage for a few hours, so anything older can't be fetched any more
+            behindSecs = account['end'] - start
+            if behindSecs > SECOND_RETENTION_SECS:
+                error('Usage data is older than the API keeps, skipping {}s; account="{}"', behindSecs - SECOND_RETENTION_SECS, account['name'])
+                start = account['end'] - SECOND_RETENTION_SECS
+
+            # Work through a backlog one window per pull, sized by how recent fetches have gone
+            windowSecs = account.setdefault('windowSecs', CATCHUP_WINDOW_SECS)
+            account['end'] = min(account['end'], start + windowSecs)
+
+            try:
+                channels = account['vue'].get_recent_usage(Scale.MINUTE.value)
+
+                # Channels that keep coming back empty, such as unused CT slots, are only probed every few pulls
+                account['pullCount'] = account.get('pullCount', 0) + 1
+                emptyPulls = account.setdefault('emptyPulls', {})
+                if account['pullCount'] % EMPTY_PROBE_PULLS != 0:
+                    channels = [chan for chan in channels if emptyPulls.get((chan.device_gid, chan.channel_num), 0) < EMPTY_CHANNEL_PULLS]
+                    if not channels:
+                        info('All channels skipped as recently empty; account="{}"', account['name'])
+                        continue
+
+                usageDataPoints = []
+                startTime = toApiTime(start)
+                endTime = toApiTime(account['end'])
+
+                # Usage requests are independent and network bound, so issue them concurrently
+                usages = list(fetchExecutor.map(lambda chan: account['vue'].get_usage_over_time(chan, startTime, endTime), channels))
+                account['failures'] = 0
+                account['windowSecs'] = min(windowSecs * 2, MAX_CATCHUP_SECS)
+
+                # Decode everything first so an empty pull never pays for formatting
+                decoded = []
+                for chan, usage in zip(channels, usages):
+                    # None entries become NaN, so missing seconds can be masked out in one pass
+                    usage = np.array(usage, dtype=np.float64)
+                    offsets = np.flatnonzero(np.isfinite(usage))
+                    decoded.append((chan, usage[offsets], offsets))
+
+                # A device with no data on any channel is likely offline, so its channels aren't counted as empty
+                activeDevices = {chan.device_gid for chan, watts, offsets in decoded if offsets.size}
+                for chan, watts, offsets in decoded:
+                    key = (chan.device_gid, chan.channel_num)
+                    if offsets.size:
+                        emptyPulls.pop(key, None)
+                    elif chan.device_gid in activeDevices:
+                        emptyPulls[key] = emptyPulls.get(key, 0) + 1
+
+                counts = np.array([offsets.size for chan, watts, offsets in decoded], dtype=np.int64)
+                if not counts.any():
+                    info('No new datapoints; account="{}"', account['name'])
+                    continue
+
+                for chan, watts, offsets in decoded:
+                    linePrefix = lookupLinePrefix(account, chan)
+                    usageDataPoints.extend(formatLines(linePrefix, watts, start + offsets))
+
+                pullBatches.append((account['name'], account['end'], usageDataPoints))
+                pullPointCount += len(usageDataPoints)
+                # Hand off a full batch right away rather than holding it for the remaining accounts
+                if pullPointCount >= WRITE_BATCH_SIZE:
+                    queueDataPoints(writeQueue, pullBatches)
+                    pullBatches = []
+                    pullPointCount = 0
+                activeCounts = counts[counts > 0]
+                info('Collected datapoints; account="{}"; points={}; channels={}; minPoints={}; maxPoints={}', account['name'], len(usageDataPoints), activeCounts.size, activeCounts.min(), activeCounts.max())
+            except (requests.exceptions.RequestException, BotoCoreError):
+                # Token refreshes go through boto3, so an AWS endpoint outage surfaces as a botocore error
+                backoff = deferAccount(account, start, pullTime)
+                error('Failed to fetch new usage data, retrying in {}s; account="{}": {}', backoff, account['name'], sys.exc_info())
+            except Exception:
+                error('Failed to record new usage data: {}', sys.exc_info())
+
+        if pullBatches:
+            queueDataPoints(writeQueue, pullBatches)
+
+        state.pauseEvent.wait(max(0.0, nextPullTime - time.monotonic()))
+
+    fetchExecutor.shutdown()
+
+    # Let the writer flush anything still queued before exiting
+    writeQueue.put(None)
+    writer.join()
+
+    saveLastUsageTimes(stateFilename, writtenUsageTimes)
+
+    info('Finished')
+
+if __name__ == '__main__':
+    main(sys.argv)